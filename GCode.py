@@ -20,57 +20,88 @@
 
 import logging
 import functools
+import re
+import sys
+import bisect
+import itertools
+from typing import Optional
+
+# Matches a single line of GCode, capturing (Verb, Parameters, Comment)
+# ex. 'G1 X3.14 Y2.72 ; Go to (pi, e)' -> ('G1', ' X3.14 Y2.72 ', 'Go to (pi, e)')
+_LINE_RE = re.compile(r'^[^\S\n]*([^\s;]*)([^;\n]*)(?:; *([^\n]*))?$', re.MULTILINE)
 
 class GCodeCommand:
 
-    verb:str = '' # String of GCode Command Verb (ex. 'G1', 'M05')
-    parameters:dict = {} # Dictionary of parameters to verb and their values (ex. {'X':3.1 'Y':4.1 'Z':5.9})
-    comment:str = ''
+    # Fixed attributes instead of a per-instance __dict__, there is one of these per line
+    __slots__ = ('verb', 'parameters', 'comment')
+
+    verb:str # String of GCode Command Verb (ex. 'G1', 'M05')
+    parameters:dict # Dictionary of parameters to verb and their values (ex. {'X':3.1 'Y':4.1 'Z':5.9})
+    comment:str
+
+    def __init__(self, verb:str = '', parameters:dict = None, comment:str = ''):
+
+        self.verb = verb
+        self.parameters = {} if parameters is None else parameters
+        self.comment = comment
 
     def _getNum(self, number:str):
         '''Returns the value as an integer or float based off context'''
+
+        # Check for integers up front, raising ValueError is slow
+        if number.isdecimal() or (number[:1] in ('-', '+') and number[1:].isdecimal()):
+            return int(number)
+
         try:
-            try:
-                return int(number)
-            except ValueError:
-                return float(number)
+            return float(number)
         except ValueError:
             return number
 
     def getFullCommand(self) -> str:
         '''Returns the full command, with comments'''
 
-        text = self.getCommand()
-
         if self.comment:
-            text = text + '; ' + self.comment
+            return f'{self.getCommand()}; {self.comment}'
 
-        return text
+        return self.getCommand()
 
     def getCommand(self) -> str:
         '''Returns just the command, no comments'''
-        text = self.verb
+        parts = [self.verb]
 
         for key, value in self.parameters.items():
 
-            text = text + ' ' + key
-            if not type(value) == str:
-                text = text + str(round(value,5))
+            if type(value) == str:
+                parts.append(key)
+            else:
+                # Round to 5 decimal places, dropping trailing zeros
+                parts.append(key + f'{value:.5f}'.rstrip('0').rstrip('.'))
 
-        return text
+        return ' '.join(parts)
 
     def isACommand(self) -> bool:
         '''Returns if the command is actually a command, not just a comment'''
         return self.verb != ''
 
-class StringGCodeCommand(GCodeCommand):
+class TokenizedGCodeCommand(GCodeCommand):
+    '''Creates a GCodeCommand based off of already tokenized parts'''
+
+    __slots__ = ()
+
+    def __init__(self, verb:str, parameters:list, comment:str):
+
+        # Interned so comparing verbs against literals like 'G0' is an identity check
+        super().__init__(sys.intern(verb), {i[0]:self._getNum(i[1:]) for i in parameters}, comment)
+
+class StringGCodeCommand(TokenizedGCodeCommand):
     '''Creates a GCodeCommand based off of string'''
 
+    __slots__ = ()
+
 
     def __init__(self, string: str):            
         
-        self.verb, parameters, self.comment = self._tokenize(string)
-        self.parameters = {i[0]:self._getNum(i[1:]) for i in parameters}
+        super().__init__(*self._tokenize(string))
 
     def _tokenize(self, string:str) -> tuple:
         '''Returns the command as a tuple of tokens
@@ -78,49 +109,47 @@ class StringGCodeCommand(GCodeCommand):
         ex. ('G1', ['X3.14', 'Y2.72', 'Z6.28'], ' Go to (pi, e, tau)')
         '''
 
-        sections = string.partition(';')
-
-        command = sections[0].rstrip(' ')
-
-        comment = sections[2].lstrip(' ')
-    
-        if command:
-            commandTokens = command.split()
-
-            verb = commandTokens[0]
-            parameters = commandTokens[1:]
-        else:
-            verb = ''
-            parameters = []
+        verb, parameters, comment = _LINE_RE.match(string).groups('')
 
-        return verb, parameters, comment    
+        return verb, parameters.split(), comment
 
 class GCodeScript:
 
-    lines: list[GCodeCommand] = [] # All lines of the script as GCodeCommands
+    lines: list[GCodeCommand] # All lines of the script as GCodeCommands
+
+    def __init__(self):
+        self.lines = []
 
     def loadFromFile(self, file):
         self.loadFromString(file.read())
 
     def loadFromString(self, string:str):
-        lines = string.split('\n')
-        self.lines = [StringGCodeCommand(line.rstrip('\n')) for line in lines]
+        # Tokenize every line in a single pass instead of line by line
+        tokens = _LINE_RE.findall(string)
 
-    def orient(self):
-        '''Moves model to be in the +X +Y from the start'''
+        # Slicers repeat the same comments (ex. 'TYPE:FILL') throughout a file,
+        # so share one string per distinct comment rather than one per line
+        comments = {}
+        self.lines = [TokenizedGCodeCommand(verb, parameters.split(), comments.setdefault(comment, comment)) for verb, parameters, comment in tokens]
 
-        # Find minimum X and Y
-        xArgs = [command.parameters['X'] for command in self.lines if 'X' in command.parameters.keys()]
-        yArgs = [command.parameters['Y'] for command in self.lines if 'Y' in command.parameters.keys()]
-        minx = min([x for x in xArgs if type(x) != str])
-        miny = min([y for y in yArgs if type(y) != str])
+    def getParameterValues(self, key:str) -> list:
+        '''Returns every numeric value of the parameter key throughout the script'''
+        values = [command.parameters.get(key) for command in self.lines]
+        return [value for value in values if value is not None and type(value) != str]
 
-        # Translate all commands by minx, miny
+    def translate(self, key:str, offset:float):
+        '''Adds offset to every numeric value of the parameter key'''
         for command in self.lines:
-            if 'X' in command.parameters.keys():
-                if type(command.parameters['X']) != str: command.parameters['X'] -= minx
-            if 'Y' in command.parameters.keys():
-                if type(command.parameters['Y']) != str: command.parameters['Y'] -= miny
+            value = command.parameters.get(key)
+            if value is not None and type(value) != str:
+                command.parameters[key] = value + offset
+
+    def orient(self):
+        '''Moves model to be in the +X +Y from the start'''
+
+        # Translate all commands by the minimum X and Y
+        self.translate('X', -min(self.getParameterValues('X')))
+        self.translate('Y', -min(self.getParameterValues('Y')))
 
     def shrink(self):
         '''Removes all unneccessary data from the script (ex. comments)'''
@@ -129,11 +158,10 @@ class GCodeScript:
         logging.debug("Shrunk Commands")
 
     def _cleanCommandsFromList(self, lines:list):
+        # Filter in place so lists shared with other scripts stay in sync
+        lines[:] = [command for command in lines if command.isACommand()]
         for command in lines:
-            if command.isACommand():
-                command.comment=''
-            else:
-                lines.remove(command)
+            command.comment=''
 
 class GCodeScriptCNC(GCodeScript):
     '''GCodeScript with CNC-specific functions'''
@@ -141,8 +169,13 @@ class GCodeScriptCNC(GCodeScript):
     travelSpeed:int = 500
     feedSpeed:int = 200
     spindleSpeed:int = 10000
-    prefixGcode: list[GCodeCommand] = []
-    suffixGcode: list[GCodeCommand] = []
+    prefixGcode: list[GCodeCommand]
+    suffixGcode: list[GCodeCommand]
+
+    def __init__(self):
+        super().__init__()
+        self.prefixGcode = []
+        self.suffixGcode = []
 
     def shrink(self):
         super().shrink()
@@ -153,18 +186,44 @@ class GCodeScriptCNC(GCodeScript):
 class GCodeScriptPrinter(GCodeScript):
     '''GCodeScript with 3D-Printer specific functions'''
 
-    typeIndicies: dict = []
-    layerIndicies: list[int] = []
+    typeIndicies: dict[int, str]
+    typeChangeIndicies: list[int] # Sorted keys of typeIndicies
+    layerIndicies: list[int]
+    # Cached result of getSlicingEngine, None until detected. Cleared whenever
+    # lines is replaced or rewritten by this script, edits made to the list
+    # from elsewhere need getSlicingEngine(recompute=True)
+    slicingEngine: Optional[str]
+
+    def __init__(self):
+        super().__init__()
+        self.typeIndicies = {}
+        self.typeChangeIndicies = []
+        self.layerIndicies = []
+        self.slicingEngine = None
+
+    @property
+    def lines(self) -> list[GCodeCommand]:
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines:list[GCodeCommand]):
+        self._lines = lines
+        self._linesChanged()
+
+    def _linesChanged(self):
+        '''Clears everything cached from lines, call after rewriting lines in place'''
+        self.slicingEngine = None
+
+    def shrink(self):
+        super().shrink()
+        self._linesChanged()
     
     def computeLayerIndices(self):
         '''Returns the command indicies of layer changes.
         Works with GCode generated by PrusaSlicer and Cura, possibly more'''
 
-        layerIndicies = [] # Lines at which layer shifts occur
-
-        for index, command in enumerate(self.lines):
-            if "LAYER" in command.comment and "BEFORE" not in command.comment and "AFTER" not in command.comment:
-                layerIndicies.append(index)
+        # Lines at which layer shifts occur
+        layerIndicies = [index for index, command in enumerate(self.lines) if "LAYER" in command.comment and "BEFORE" not in command.comment and "AFTER" not in command.comment]
 
         # Cura puts a LAYER_COUNT comment into GCode that causes this 
         # tho think it is a layer shift.
@@ -180,14 +239,21 @@ class GCodeScriptPrinter(GCodeScript):
 
         if recompute: self.computeLayerIndices()
 
-        for index in range(len(self.layerIndicies)-1, -1, -1):
-            if self.layerIndicies[index] <= commandIndex:
-                return index
-        return None
+        index = bisect.bisect_right(self.layerIndicies, commandIndex) - 1
+        if index < 0:
+            return None
+        return index
 
-    def getSlicingEngine(self) -> str:
+    def getSlicingEngine(self, recompute=False) -> str:
         '''Returns the slicer used on the GCode'''
 
+        if recompute or self.slicingEngine is None:
+            self.slicingEngine = self._detectSlicingEngine()
+
+        return self.slicingEngine
+
+    def _detectSlicingEngine(self) -> str:
+
         if "PrusaSlicer" in self.lines[0].comment: 
             return "PrusaSlicer"
 
@@ -202,129 +268,128 @@ class GCodeScriptPrinter(GCodeScript):
         '''Returns dictionary of indices of changes in line types and the new type''' 
 
         typeIndicies = {0:"None"} # Lines at which line type changes occur
-
-        for index, command in enumerate(self.lines):
-            if "TYPE:" in command.comment:
-                typeIndicies[index] = command.comment.removeprefix("TYPE:")
+        typeIndicies.update({index: command.comment.removeprefix("TYPE:") for index, command in enumerate(self.lines) if "TYPE:" in command.comment})
 
         self.typeIndicies = typeIndicies
+        self.typeChangeIndicies = list(typeIndicies)
 
     def getType(self, commandIndex:int, recompute=True):
         '''Returns the print type at commandIndex'''
 
         if recompute: self.computeTypeChanges()
 
-        for key, value in list(self.typeIndicies.items())[::-1]:
-            if key <= commandIndex:
-                return value
-        
-        raise ValueError("Could not detect types")
+        index = bisect.bisect_right(self.typeChangeIndicies, commandIndex) - 1
+        if index < 0:
+            raise ValueError("Could not detect types")
+
+        return self.typeIndicies[self.typeChangeIndicies[index]]
 
 class GCodeScriptCNCFromGCodeScriptPrinter(GCodeScriptCNC, GCodeScriptPrinter):
     '''Converts GCodeScriptPrinter to GCodeScriptCNC'''
 
-    USABLE_COMMANDS = ["G1", "G0"] # List of commands that can be converted to CNC GCode commands
+    USABLE_COMMANDS = frozenset(["G1", "G0"]) # Set of commands that can be converted to CNC GCode commands
+
+    # Sorted indices of lines that are commands, not just comments. Built on first
+    # use by getCommandRelativeToIndex and cleared along with the other caches
+    _commandIndicies: Optional[list[int]]
 
     def __init__(self, printerScipt: GCodeScriptPrinter):
         
+        super().__init__()
         self.lines = printerScipt.lines
 
+    def _linesChanged(self):
+        super()._linesChanged()
+        self._commandIndicies = None
+
     def convert(self):
         
-        # Remove Printer-specific parameters
-        for command in self.lines:
-            if 'E' in command.parameters:
-                del command.parameters['E']
-            if 'F' in command.parameters:
-                del command.parameters['F']
-
-        # Remove Printer-Specific Commands
-        toRemove = []
+        # In a single pass, remove Printer-Specific Commands and parameters,
+        # mirror Z axis to make it carve down and remove multi-line travels
+        lines = []
         for command in self.lines:
             if self._isPrinterSpecificCommand(command):
-                toRemove.append(command)
+                continue
+
+            parameters = command.parameters
+            parameters.pop('E', None)
+            parameters.pop('F', None)
+
+            z = parameters.get('Z')
+            if z is not None and type(z) != str:
+                parameters['Z'] = -z
+
+            # Merge consecutive travels into the last one, keeping the Z of
+            # the first travel in the run that has one
+            if command.verb == 'G0' and lines and lines[-1].verb == 'G0':
+                z = lines[-1].parameters.get('Z')
+                if z is not None:
+                    parameters['Z'] = z
+                lines[-1] = command
+            else:
+                lines.append(command)
 
-        for i in toRemove: self.lines.remove(i)
+        self.lines = lines
 
-        logging.debug("Removed Printer-Specific Commands")
+        logging.debug("Removed Printer-Specific Commands, Mirroed Z Axis and Removed Multi-Line travels")
 
-        # Mirror Z axis to make it carve down
-        for command in self.lines:
-            if 'Z' in command.parameters.keys():
-                command.parameters['Z'] = -1*command.parameters['Z']
-
-        logging.debug("Mirroed Z Axis")
-
-        # Remove multi-line travels
-        altered = True
-        while altered:
-            altered = False
-            for index, command in enumerate(self.lines):
-                oldCommand = self.getCommandRelativeToIndex(index, -1)
-                if 'G0' == command.verb and 'G0' == oldCommand.verb:
-                    if 'Z' in oldCommand.parameters.keys():
-                        command.parameters['Z'] = oldCommand.parameters['Z']
-                    self.lines.remove(self.getCommandRelativeToIndex(index, -1))
-                    altered = True
-
-        logging.debug("Removed Multi-Line travels")
-
-        # Convert printer travels to CNC travels
+        # Convert printer travels to CNC travels (lift, move, lower back down)
+        converted = []
         altitude = 0
-        for index, command in enumerate(self.lines):
-            if 'Z' in command.parameters.keys():
-                altitude = command.parameters['Z']
+        for command in self.lines:
+            parameters = command.parameters
+            altitude = parameters.get('Z', altitude)
 
             if command.verb == "G0":
-                oldCommand = self.getCommandRelativeToIndex(index, -1)
-                endPosition = command.parameters['X'], command.parameters['Y']
-                self.lines.insert(index, StringGCodeCommand(f"G1 Z{self.clearance} F{self.travelSpeed}"))
-                self.lines.insert(index+1, StringGCodeCommand(f"G1 X{endPosition[0]} Y{endPosition[1]}"))
-                if 'Z' in command.parameters.keys():
-                    newAltitude = command.parameters['Z']
-                else:
-                    newAltitude = altitude
-                self.lines[index+2] = StringGCodeCommand(f"G1 Z{newAltitude} F{self.feedSpeed}")
+                converted.append(GCodeCommand("G1", {'Z':self.clearance, 'F':self.travelSpeed}))
+                converted.append(GCodeCommand("G1", {'X':parameters['X'], 'Y':parameters['Y']}))
+                converted.append(GCodeCommand("G1", {'Z':altitude, 'F':self.feedSpeed}))
+            else:
+                converted.append(command)
+
+        self.lines = converted
 
         logging.debug("Converted from Printer travels to CNC travels")
 
     def export(self) -> str:
         '''Returns the GCode Script as a string'''
 
-        final = self.prefixGcode
-        final.extend(self.lines)
-        final.extend(self.suffixGcode)
+        final = self.prefixGcode + self.lines + self.suffixGcode
         
-        result = ''
+        return ''.join([command.getFullCommand() + '\n' for command in final])
+
+    def exportToFile(self, file):
+        '''Writes the GCode Script to file without building it as one string first'''
 
-        for command in final:
-            result = result + command.getFullCommand() + '\n'
+        final = itertools.chain(self.prefixGcode, self.lines, self.suffixGcode)
 
-        return result
+        file.writelines(command.getFullCommand() + '\n' for command in final)
 
     def getCommandRelativeToIndex(self, index:int, offset:int):
         '''Returns command at index+offset skipping over comments'''
 
-        iteration = offset//abs(offset) # Get sign of offset and use that to iterate
-        currentOffset = 0
+        if self._commandIndicies is None:
+            self._commandIndicies = [index for index, command in enumerate(self.lines) if command.isACommand()]
 
-        while currentOffset != offset:
-            index += iteration
-            if self.lines[index].isACommand(): currentOffset += iteration
+        # Rank of the command at index among all commands, counting from
+        # the nearest command in the direction of offset if index is a comment
+        if offset > 0:
+            rank = bisect.bisect_right(self._commandIndicies, index) - 1
+        else:
+            rank = bisect.bisect_left(self._commandIndicies, index)
 
-        return self.lines[index]
+        return self.lines[self._commandIndicies[rank + offset]]
 
 
     def _isPrinterSpecificCommand(self, command: GCodeCommand) -> bool:
-        if command.verb not in self.USABLE_COMMANDS: return True
-        return False
+        return command.verb not in self.USABLE_COMMANDS
 
     def removeInfill(self, infillFrequency:int):
         '''Removes uneccessary infill to speed up Mill time.
         Keeps infill only every infillFrequency layers.
         Call before running convert()'''
 
-        toPop = []
+        toPop = set()
 
         self.computeLayerIndices()
         self.computeTypeChanges()
@@ -333,7 +398,8 @@ class GCodeScriptCNCFromGCodeScriptPrinter(GCodeScriptCNC, GCodeScriptPrinter):
             
             if "fill" in self.getType(index, recompute=False).lower() and self.getLayer(index, recompute=False)%infillFrequency != 0:
                 command = self.lines[index]
-                if command.verb != "G0": toPop.append(index) # Keep travels so layer shifts aren't broken
+                if command.verb != "G0": toPop.add(index) # Keep travels so layer shifts aren't broken
 
-        for pop in toPop[::-1]:
-            self.lines.pop(pop)
\ No newline at end of file
+        # Rebuild the list in one pass rather than popping (and shifting) each line
+        self.lines[:] = [command for index, command in enumerate(self.lines) if index not in toPop]
+        self._linesChanged()
\ No newline at end of file
@@ -21,83 +21,179 @@
 import GCode
 import logging
 import argparse
-
-DEFAULT_PREFIX ="""G1 X0 Y{clearance} Z0
-G92 X0 Y0 Z0
-G90
-G1 Z{clearance} F{travelRate}
-G1 X0 Y0
-M03 S{spindleSpeed}"""
-
-DEFAULT_SUFFIX = """G1 Z{clearance} F{travelRate}
-M05
-G1 X0 Y0 M30"""
+import multiprocessing
+import os
+import sys
 
 
 # Add commmand-line Arguments
 parser = argparse.ArgumentParser(description="Convert 3D Printer GCode to CNC GCode")
-parser.add_argument("SOURCE", type=argparse.FileType('r'))
-parser.add_argument("DEST", type=argparse.FileType('w'))
+parser.add_argument("SOURCE", nargs="+", help="GCode file(s) to convert")
+parser.add_argument("DEST", help="File to write to, or a directory to write into when converting multiple files")
 parser.add_argument("-c", "--clearance", help="Height above the model to use during travels", type=int, default=3)
 parser.add_argument("-f", "--feedrate", help="Speed to move while milling", type=int, default=200)
 parser.add_argument("-i", "--infill-frequency", help = "How often to keep infill (in layers)", default=10, type=int)
+parser.add_argument("-j", "--jobs", help="Number of files to convert at once. Defaults to the number of CPUs", type=int, default=None)
 parser.add_argument("-k", "--keep-infill", help="Do not remove excess infill", action="store_true", default=False)
 parser.add_argument("-n", "--no-orient", help="Do not move model to origin", action="store_true", default=False)
-parser.add_argument("--prefix", type=str, default=DEFAULT_PREFIX, help="GCode to prepend instructions with. Defaults to a generic initialization sequence")
-parser.add_argument("--suffix", type=str, default=DEFAULT_SUFFIX, help="GCode to append instructions with. Defaults to a generic ending sequence")
+parser.add_argument("--prefix", type=str, default=None, help="GCode to prepend instructions with, may use {clearance}, {feedRate}, {infillFrequency}, {spindleSpeed} and {travelRate}. Defaults to a generic initialization sequence")
+parser.add_argument("--suffix", type=str, default=None, help="GCode to append instructions with, may use the same fields as --prefix. Defaults to a generic ending sequence")
 parser.add_argument("-s", "--spindle-speed", help="Spindle rotation speed", type=int, default=10000)
 parser.add_argument("--shrink", help="Shrink file size as much as possible", action="store_true", default=False)
 parser.add_argument("-t", "--travelrate", help="Speed to move while travelling", type=int, default=500)
 parser.add_argument("-v", "--verbose", action="store_true", default=False)
 
-args = parser.parse_args()
-
-# Configure logging
-logging.basicConfig(format = "[%(asctime)s] %(levelname)s: %(message)s")
-logger = logging.getLogger()
-if args.verbose: logger.setLevel(logging.DEBUG)
-else: logger.setLevel(logging.INFO)
-
-printerGcode = GCode.GCodeScriptPrinter()
-printerGcode.loadFromFile(args.SOURCE)
-
-# Load converter
-GCodeCNC = GCode.GCodeScriptCNCFromGCodeScriptPrinter(printerGcode)
-GCodeCNC.clearance = args.clearance
-GCodeCNC.feedSpeed = args.feedrate
-GCodeCNC.travelSpeed = args.travelrate
-GCodeCNC.spindleSpeed = args.spindle_speed
-
-logging.info("Loaded GCode")
-
-# Do optional transformations
-if not args.keep_infill: 
-    GCodeCNC.removeInfill(args.infill_frequency)
-    logging.debug("Infill Removed")
-if not args.no_orient: 
-    GCodeCNC.orient()
-    logging.debug("Model Oriented")
-
-logging.info("Completed optional transformations")
-
-# Convert
-GCodeCNC.convert()
+class SourceFilter(logging.Filter):
+    '''Adds the file this process is converting to log records as %(source)s'''
+
+    source:str = ''
+
+    def filter(self, record) -> bool:
+        record.source = self.source
+        return True
+
+sourceFilter = SourceFilter()
+
+def configureLogging(verbose:bool, batch:bool = False):
+    handler = logging.StreamHandler()
+    if batch:
+        # Workers interleave their output, so name the file each message is about
+        handler.addFilter(sourceFilter)
+        logging.basicConfig(format = "[%(asctime)s] %(levelname)s: %(source)s: %(message)s", handlers = [handler], force = True)
+    else:
+        logging.basicConfig(format = "[%(asctime)s] %(levelname)s: %(message)s", handlers = [handler], force = True)
+    logger = logging.getLogger()
+    if verbose: logger.setLevel(logging.DEBUG)
+    else: logger.setLevel(logging.INFO)
+
+def defaultPrefix(args) -> list:
+    '''Returns the generic initialization sequence, built directly rather than parsed'''
+    return [
+        GCode.GCodeCommand("G1", {'X':0, 'Y':args.clearance, 'Z':0}),
+        GCode.GCodeCommand("G92", {'X':0, 'Y':0, 'Z':0}),
+        GCode.GCodeCommand("G90"),
+        GCode.GCodeCommand("G1", {'Z':args.clearance, 'F':args.travelrate}),
+        GCode.GCodeCommand("G1", {'X':0, 'Y':0}),
+        GCode.GCodeCommand("M03", {'S':args.spindle_speed}),
+    ]
+
+def defaultSuffix(args) -> list:
+    '''Returns the generic ending sequence, built directly rather than parsed'''
+    return [
+        GCode.GCodeCommand("G1", {'Z':args.clearance, 'F':args.travelrate}),
+        GCode.GCodeCommand("M05"),
+        GCode.GCodeCommand("G1", {'X':0, 'Y':0, 'M':30}),
+    ]
+
+def loadTemplate(template:str, args) -> list:
+    '''Returns the commands of a user supplied prefix or suffix template'''
+    script = GCode.GCodeScript()
+    script.loadFromString(template.format(clearance=args.clearance, feedRate=args.feedrate, infillFrequency=args.infill_frequency, spindleSpeed=args.spindle_speed, travelRate=args.travelrate))
+    return script.lines
+
+def convert(source, dest, args):
+    '''Converts the printer GCode read from source and writes the CNC GCode to dest'''
+
+    printerGcode = GCode.GCodeScriptPrinter()
+    printerGcode.loadFromFile(source)
+
+    # Load converter
+    GCodeCNC = GCode.GCodeScriptCNCFromGCodeScriptPrinter(printerGcode)
+    GCodeCNC.clearance = args.clearance
+    GCodeCNC.feedSpeed = args.feedrate
+    GCodeCNC.travelSpeed = args.travelrate
+    GCodeCNC.spindleSpeed = args.spindle_speed
+
+    logging.info("Loaded GCode")
+
+    # Do optional transformations
+    if not args.keep_infill: 
+        GCodeCNC.removeInfill(args.infill_frequency)
+        logging.debug("Infill Removed")
+    if not args.no_orient: 
+        GCodeCNC.orient()
+        logging.debug("Model Oriented")
+
+    logging.info("Completed optional transformations")
+
+    # Convert
+    GCodeCNC.convert()
+
+    # Add prefix and suffix and export
+    if args.prefix is None: GCodeCNC.prefixGcode = defaultPrefix(args)
+    else: GCodeCNC.prefixGcode = loadTemplate(args.prefix, args)
+
+    if args.suffix is None: GCodeCNC.suffixGcode = defaultSuffix(args)
+    else: GCodeCNC.suffixGcode = loadTemplate(args.suffix, args)
+
+    if args.shrink:
+        GCodeCNC.shrink()
+
+    GCodeCNC.exportToFile(dest)
+
+def convertPath(sourcePath:str, destPath:str, args) -> bool:
+    '''Converts between two file paths, run in a worker process when converting multiple files.
+    Returns whether the conversion succeeded'''
+
+    sourceFilter.source = sourcePath
+
+    destOpened = False
+    try:
+        with open(sourcePath, 'r') as source, open(destPath, 'w', 1 << 20) as dest:
+            destOpened = True
+            convert(source, dest, args)
+    except Exception:
+        logging.exception(f"Could not convert {sourcePath}")
+
+        # Don't leave partial output behind
+        if destOpened and os.path.exists(destPath):
+            os.remove(destPath)
+
+        return False
+
+    logging.info(f"Converted to {destPath}")
+    return True
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    configureLogging(args.verbose)
+
+    if len(args.SOURCE) == 1 and not os.path.isdir(args.DEST):
+        try:
+            source = argparse.FileType('r')(args.SOURCE[0])
+            dest = argparse.FileType('w', 1 << 20)(args.DEST)
+        except argparse.ArgumentTypeError as error:
+            parser.error(str(error))
+
+        with source, dest:
+            convert(source, dest, args)
+    else:
+        if not os.path.isdir(args.DEST):
+            parser.error("DEST must be a directory when converting multiple files")
+
+        # Files are independent, so convert them in parallel, one per process
+        jobs = []
+        destPaths = {}
+        for sourcePath in args.SOURCE:
+            if not os.path.isfile(sourcePath):
+                parser.error(f"can't open '{sourcePath}': No such file")
 
-# Add prefix and suffix and export
-prefixGcode = GCode.GCodeScript()
-prefixGcode.loadFromString(args.prefix.format(clearance=args.clearance, feedRate=args.feedrate, infillFrequency=args.infill_frequency, spindleSpeed=args.spindle_speed, travelRate=args.travelrate))
-GCodeCNC.prefixGcode = prefixGcode.lines
+            name = os.path.splitext(os.path.basename(sourcePath))[0] + ".nc"
+            destPath = os.path.join(args.DEST, name)
 
-suffixGcode = GCode.GCodeScript()
-suffixGcode.loadFromString(args.suffix.format(clearance=args.clearance, feedRate=args.feedrate, infillFrequency=args.infill_frequency, spindleSpeed=args.spindle_speed, travelRate=args.travelrate))
-GCodeCNC.suffixGcode = suffixGcode.lines
+            # Workers would overwrite each other's output
+            if destPath in destPaths:
+                parser.error(f"'{destPaths[destPath]}' and '{sourcePath}' would both be written to '{destPath}'")
+            destPaths[destPath] = sourcePath
 
-if args.shrink:
-    GCodeCNC.shrink()
+            jobs.append((sourcePath, destPath, args))
 
-output = GCodeCNC.export()
+        # chunksize=1 so a failing file can't take the rest of its chunk with it
+        with multiprocessing.Pool(args.jobs, initializer=configureLogging, initargs=(args.verbose, True)) as pool:
+            results = pool.starmap(convertPath, jobs, chunksize=1)
 
-logging.info("Done")
+        if not all(results):
+            sys.exit(1)
 
-args.DEST.truncate()
-args.DEST.write(output)
\ No newline at end of file
+    logging.info("Done")
\ No newline at end of file